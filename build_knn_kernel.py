@@ -0,0 +1,58 @@
+import click
+import numba
+import numpy as np
+from pathlib import Path
+from numba.pycc import CC
+
+from this_tutorial.knn_ray import _nearest_k4
+
+MODULE_NAME = "knn_native"
+DEFAULT_OUTPUT_DIR = Path(__file__).parent / "src" / "this_tutorial"
+
+cc = CC(MODULE_NAME)
+
+
+@cc.export("knn_k4_f32", "i8[:,:](f4[:,:], f4[:,:])")
+def knn_k4(query_points, reference_points):
+    n_query = query_points.shape[0]
+    indices = np.empty((n_query, 4), dtype=np.int64)
+    for q in range(n_query):
+        i0, i1, i2, i3 = _nearest_k4(query_points, q, reference_points)
+        indices[q, 0] = i0
+        indices[q, 1] = i1
+        indices[q, 2] = i2
+        indices[q, 3] = i3
+    return indices
+
+
+@cc.export("knn_mean_price_k4_f32", "f4[:](f4[:,:], f4[:,:], f4[:])")
+def knn_mean_price_k4(query_points, reference_points, reference_prices):
+    n_query = query_points.shape[0]
+    prices = np.empty(n_query, dtype=np.float32)
+    for q in range(n_query):
+        i0, i1, i2, i3 = _nearest_k4(query_points, q, reference_points)
+        price_sum = reference_prices[i0] + reference_prices[i1] + reference_prices[i2] + reference_prices[i3]
+        prices[q] = price_sum / numba.float32(4)
+    return prices
+
+
+@click.command()
+@click.option("-o", "--output-dir", type=click.Path(path_type=Path, file_okay=False), default=DEFAULT_OUTPUT_DIR)
+def run(*, output_dir: Path):
+    """
+    Compile the k=4 nearest neighbour kernels ahead of time into `this_tutorial.knn_native`.
+
+    Ray workers started with `knn_ray --exhaustive` then import the compiled
+    extension instead of paying Numba's JIT compilation on their first call.
+    The AOT kernels cannot use `parallel`, `fastmath` or `boundscheck=False`,
+    so they are only used when requested (`compute_prices(..., native=True)`).
+
+    Note: `numba.pycc` emits a NumbaPendingDeprecationWarning; Numba plans to
+    replace it with a new AOT mechanism.
+    """
+    cc.output_dir = str(output_dir)
+    cc.compile()
+
+
+if __name__ == "__main__":
+    run()
@@ -8,8 +8,11 @@ This module implements a mathematical function that models house prices based on
 4. Smooth price decay from premium locations
 """
 
+import functools
 import json
+import zlib
 from pathlib import Path
+import numba
 import numpy as np
 from typing import Optional
 
@@ -18,8 +21,66 @@ import plotly.graph_objects as go
 
 DEFAULT_CITY_DEFINITION_PATH = Path(__file__).parent / "city_definition.json"
 
+# exp(-x) is below 1e-8 past this point, which is negligible next to any price
+FAST_EXP_NEG_CUTOFF = 20.0
+# fastmath without the "nnan"/"ninf" flags, so NaN inputs still propagate
+FASTMATH_FLAGS = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+@numba.njit(inline="always", fastmath=FASTMATH_FLAGS)
+def _exp_neg(x):
+    # Clamp so the polynomial cannot overflow for large x (NaN passes through)
+    t = (FAST_EXP_NEG_CUTOFF if x > FAST_EXP_NEG_CUTOFF else x) * (1.0 / 128.0)
+    p = 1.0 - t * (
+        1.0
+        - t
+        * (
+            1.0 / 2.0
+            - t * (1.0 / 6.0 - t * (1.0 / 24.0 - t * (1.0 / 120.0 - t * (1.0 / 720.0))))
+        )
+    )
+    p = p * p
+    p = p * p
+    p = p * p
+    p = p * p
+    p = p * p
+    p = p * p
+    p = p * p
+    return 0.0 if x > FAST_EXP_NEG_CUTOFF else p
+
+
+@numba.vectorize(
+    [numba.float32(numba.float32), numba.float64(numba.float64)], fastmath=FASTMATH_FLAGS
+)
+def fast_exp_neg(x):
+    """
+    Approximate exp(-x) for x >= 0 (relative error ~1e-7).
 
-def house_price_model(x, y, floor, city_params: Optional[dict] = None):
+    Evaluates exp(-x / 128) with a degree-6 polynomial in Horner form and
+    squares the result 7 times. The body is branch-free, so it vectorizes.
+    Returns 0 for x > FAST_EXP_NEG_CUTOFF; NaN stays NaN.
+    """
+    return _exp_neg(x)
+
+
+@numba.vectorize(
+    [numba.float64(numba.float64, numba.float64, numba.float64, numba.float64, numba.float64, numba.float64)],
+    fastmath=FASTMATH_FLAGS,
+)
+def _center_influence(x, y, center_x, center_y, scale, peak):
+    """Price influence of one center: peak * exp(-scale * squared distance), in one pass."""
+    dx = x - center_x
+    dy = y - center_y
+    return peak * _exp_neg(scale * (dx * dx + dy * dy))
+
+
+def house_price_model(
+    x,
+    y,
+    floor,
+    city_params: Optional[dict] = None,
+    rng: Optional[np.random.Generator] = None,
+):
     """
     Calculate house prices based on location and floor number.
 
@@ -33,6 +94,9 @@ def house_price_model(x, y, floor, city_params: Optional[dict] = None):
         Floor number (1-based, where 1 is ground floor)
     city_params : dict, optional
         Parameters defining the city structure. If None, uses default parameters.
+    rng : np.random.Generator, optional
+        Source of the price noise. If None, a generator seeded from the
+        coordinates is used, so equal inputs always give equal prices.
 
     Returns:
     --------
@@ -57,19 +121,18 @@ def house_price_model(x, y, floor, city_params: Optional[dict] = None):
     # Initialize price with base price
     price = np.full(broadcast_shape, city_params["base_price"], dtype=float)
 
-    # Calculate influence from each high-end center and take maximum
-    for center in city_params["high_end_centers"]:
-        # Calculate distance from this center
-        distance = np.sqrt((x - center["x"]) ** 2 + (y - center["y"]) ** 2)
-
-        # Calculate price influence using Gaussian-like decay
-        influence = center["peak_price"] * np.exp(
-            -city_params["distance_decay"]
-            * (distance / center["influence_radius"]) ** 2
+    # Calculate influence from each high-end center and take maximum.
+    # One fused pass per center into a reused buffer beats a (*grid, n_centers)
+    # tensor: reducing over a short trailing axis is slow, temporaries are large.
+    influence = np.empty(np.broadcast_shapes(x.shape, y.shape), dtype=float)
+    for (center_x, center_y), peak, radius2 in zip(*_center_arrays(city_params)):
+        # Price influence using Gaussian-like decay
+        _center_influence(
+            x, y, center_x, center_y, city_params["distance_decay"] / radius2, peak, out=influence
         )
 
         # Take maximum between current price and this center's influence
-        price = np.maximum(price, influence)
+        np.maximum(price, influence, out=price)
 
     # Apply floor premium (compound growth)
     floor_multiplier = (1 + city_params["floor_premium"]) ** (floor - 1)
@@ -77,23 +140,51 @@ def house_price_model(x, y, floor, city_params: Optional[dict] = None):
 
     # Add some realistic noise/variation
     if city_params["noise_factor"] > 0:
-        # Use deterministic noise based on coordinates for reproducibility
-        np.random.seed(int(np.sum(x * 1000 + y * 1000) % 2**32))
-        noise = 1 + city_params["noise_factor"] * (
-            np.random.random(broadcast_shape) - 0.5
-        )
+        if rng is None:
+            # Use deterministic noise based on coordinates for reproducibility
+            # (a checksum of the raw bytes, unlike hash(), is stable across processes;
+            # hashing float64 keeps the seed independent of the input dtype)
+            x_bytes = np.asarray(x, dtype=np.float64).tobytes()
+            y_bytes = np.asarray(y, dtype=np.float64).tobytes()
+            seed = zlib.crc32(y_bytes, zlib.crc32(x_bytes))
+            rng = np.random.default_rng(seed)
+        noise = 1 + city_params["noise_factor"] * (rng.random(broadcast_shape) - 0.5)
         price *= noise
 
     return price
 
 
-def load_city_params(path: Path) -> dict:
+def _center_arrays(city_params: dict) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Stack the high-end center definitions into arrays ready for broadcasting.
+
+    Returns:
+    --------
+    centers_xy : np.ndarray
+        (n_centers, 2) array of center coordinates
+    peaks : np.ndarray
+        (n_centers,) array of peak prices
+    radii2 : np.ndarray
+        (n_centers,) array of squared influence radii
+    """
+    centers = city_params["high_end_centers"]
+    centers_xy = np.array([[c["x"], c["y"]] for c in centers], dtype=float).reshape(-1, 2)
+    peaks = np.array([c["peak_price"] for c in centers], dtype=float)
+    radii2 = np.array([c["influence_radius"] for c in centers], dtype=float) ** 2
+    return centers_xy, peaks, radii2
+
+
+@functools.lru_cache(maxsize=8)
+def load_city_params(path: Path | str) -> dict:
     """
     Load model parameters from a JSON file.
 
+    The file is parsed only once per path; the returned dictionary is shared
+    between callers and must not be modified (copy it first).
+
     Parameters:
     -----------
-    path: Path
+    path: Path or str
         An existing JSON file
 
     Returns:
@@ -101,7 +192,7 @@ def load_city_params(path: Path) -> dict:
     params: dict
         A dictionary with parameters (unchecked for correctness)
     """
-    with path.open() as f:
+    with Path(path).open() as f:
         return json.load(f)
 
 
@@ -1,10 +1,24 @@
 # knn_ray + object store + batches
+import importlib.util
 import logging
 from pathlib import Path
 
+import click
+import numba
 import pandas as pd
+import polars as pl
 import numpy as np
 import ray
+from scipy.spatial import cKDTree
+
+# Optional SIMD backend (`use_simsimd=True`), see the `simd` extra. It is imported
+# lazily because the module (named "SimSIMD") cannot be pickled by Ray when run
+# as a script.
+HAS_SIMSIMD = importlib.util.find_spec("simsimd") is not None
+
+# Ahead-of-time compiled k=4 kernels, built by `build_knn_kernel.py`. Also
+# imported lazily: the compiled functions cannot be pickled by Ray.
+HAS_NATIVE_KNN = importlib.util.find_spec("this_tutorial.knn_native") is not None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,6 +27,61 @@ logger = logging.getLogger(__name__)
 N_POINTS = 10   # Default number of points in each dimension for the grid
 LIMIT = 10.0    # +/- Span of the grid
 DEFAULT_K = 4   # How many nearest neighbors to consider
+STREAMING_MAX_K = 16  # Largest k for which the streaming Numba search is used
+KDTREE_LEAFSIZE = 32  # Number of points at which the k-d tree switches to brute force
+L2_CACHE_BYTES = 512 * 1024  # Per-core L2 cache size used to tile distance blocks
+MIN_BATCH_SIZE = 64  # Smallest number of query points per distance block
+RAY_BATCH_SIZE = 50_000  # Number of query points per Ray task
+# Below this many query points a batch is computed in-process: a Ray task costs
+# ~5 ms to schedule, while a k-d tree price lookup takes ~1 µs per point
+MIN_REMOTE_BATCH_SIZE = 4096
+
+
+def calculate_squared_distances(
+    query_points: np.ndarray,
+    reference_points: np.ndarray,
+    *,
+    n_dim: int = 3,
+    use_simsimd: bool = False,
+) -> np.ndarray:
+    """
+    Calculate mutual squared Euclidean distances between M query and N reference points.
+
+    Uses the |q - r|² = |q|² + |r|² - 2 q·r identity so that the heavy lifting
+    is a single matrix product (BLAS GEMM) instead of a (M, N, n_dim) temporary.
+    The fused `simsimd.cdist` kernel is opt-in: for n_dim = 3 it is ~3x slower
+    than the GEMM (0.20 s vs 0.07 s for 2000 x 10000 points).
+
+    Parameters:
+    ----------
+    query_points: np.ndarray
+        (M, n_dim+) array of query points
+    reference_points: np.ndarray
+        (N, n_dim+) array of reference points
+    n_dim: int
+        Number of dimensions to consider (default: 3, for x, y, floor)
+    use_simsimd: bool
+        Use `simsimd.cdist` (requires the `simd` extra) instead of the GEMM
+
+    Returns:
+    --------
+    squared_distances: np.ndarray
+        (M, N) float32 array of the squared distances
+    """
+    # float32 halves the memory traffic and makes `@` dispatch to SGEMM
+    query = np.ascontiguousarray(query_points[:, :n_dim], dtype=np.float32)
+    reference = np.ascontiguousarray(reference_points[:, :n_dim], dtype=np.float32)
+    if use_simsimd:
+        from simsimd import cdist
+
+        return np.asarray(cdist(query, reference, metric="sqeuclidean", out_dtype="float32"))
+
+    query_sq = np.einsum("ij,ij->i", query, query)
+    reference_sq = np.einsum("ij,ij->i", reference, reference)
+    squared_distances = query_sq[:, np.newaxis] + reference_sq[np.newaxis, :] - 2.0 * query @ reference.T
+    # Rounding can make (near-)zero distances slightly negative
+    np.maximum(squared_distances, 0, out=squared_distances)
+    return squared_distances
 
 
 def calculate_distances(query_points: np.ndarray, reference_points: np.ndarray, *, n_dim: int = 3) -> np.ndarray:
@@ -33,10 +102,163 @@ def calculate_distances(query_points: np.ndarray, reference_points: np.ndarray,
     distances: np.ndarray
         (M, N) array of the distances
     """
-    # Expand for broadcasting
-    query_points = query_points[:, np.newaxis,:n_dim]
-    reference_points = reference_points[np.newaxis, :, :n_dim]
-    return np.sqrt(np.sum((reference_points - query_points) ** 2, axis=-1))
+    distances = calculate_squared_distances(query_points, reference_points, n_dim=n_dim)
+    return np.sqrt(distances, out=distances)
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def knn_search_numba(query_points: np.ndarray, reference_points: np.ndarray, k: int) -> np.ndarray:
+    """
+    Find k nearest neighbour reference point indices in a single streaming pass.
+
+    Each query point keeps its own k best candidates while scanning the
+    reference points, so the (M, N) distance matrix is never materialized.
+
+    Parameters:
+    ----------
+    query_points: np.ndarray
+        (M, 3+) array of query points
+    reference_points: np.ndarray
+        (N, 3+) array of reference points, N >= k
+    k: int
+        Number of nearest neighbors to find
+
+    Returns:
+    --------
+    indices: np.ndarray
+        (M, k) matrix of integral indices (in no particular order)
+    """
+    n_query = query_points.shape[0]
+    n_reference = reference_points.shape[0]
+    indices = np.empty((n_query, k), dtype=np.int64)
+    for q in numba.prange(n_query):
+        qx = query_points[q, 0]
+        qy = query_points[q, 1]
+        qz = query_points[q, 2]
+        best_d = np.empty(k, dtype=np.float64)
+        best_i = np.empty(k, dtype=np.int64)
+        # Seed the candidates with the first k points (avoids inf under fastmath)
+        for r in range(k):
+            dx = reference_points[r, 0] - qx
+            dy = reference_points[r, 1] - qy
+            dz = reference_points[r, 2] - qz
+            best_d[r] = dx * dx + dy * dy + dz * dz
+            best_i[r] = r
+        worst = np.argmax(best_d)
+        for r in range(k, n_reference):
+            dx = reference_points[r, 0] - qx
+            dy = reference_points[r, 1] - qy
+            dz = reference_points[r, 2] - qz
+            d = dx * dx + dy * dy + dz * dz
+            if d < best_d[worst]:
+                best_d[worst] = d
+                best_i[worst] = r
+                worst = np.argmax(best_d)
+        indices[q] = best_i
+    return indices
+
+
+@numba.njit(inline="always")
+def _insert_k4(d, i, d0, i0, d1, i1, d2, i2, d3, i3):
+    """Insert candidate (d, i) into the sorted slots 0..3, given d < d3."""
+    if d < d2:
+        d3, i3 = d2, i2
+        if d < d1:
+            d2, i2 = d1, i1
+            if d < d0:
+                d1, i1 = d0, i0
+                d0, i0 = d, i
+            else:
+                d1, i1 = d, i
+        else:
+            d2, i2 = d, i
+    else:
+        d3, i3 = d, i
+    return d0, i0, d1, i1, d2, i2, d3, i3
+
+
+@numba.njit(inline="always")
+def _nearest_k4(query_points, q, reference_points):
+    """Indices of the 4 reference points nearest to query point q, nearest first."""
+    qx = query_points[q, 0]
+    qy = query_points[q, 1]
+    qz = query_points[q, 2]
+    # Finite sentinel, fastmath assumes there are no infinities
+    far = np.finfo(np.float64).max
+    d0, d1, d2, d3 = far, far, far, far
+    i0, i1, i2, i3 = 0, 0, 0, 0
+    for r in range(reference_points.shape[0]):
+        dx = reference_points[r, 0] - qx
+        dy = reference_points[r, 1] - qy
+        dz = reference_points[r, 2] - qz
+        d = dx * dx + dy * dy + dz * dz
+        if d < d3:
+            d0, i0, d1, i1, d2, i2, d3, i3 = _insert_k4(d, r, d0, i0, d1, i1, d2, i2, d3, i3)
+    return i0, i1, i2, i3
+
+
+@numba.njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def knn_search_k4(query_points: np.ndarray, reference_points: np.ndarray) -> np.ndarray:
+    """
+    Find the 4 nearest neighbour reference point indices in a single streaming pass.
+
+    Specialisation of `knn_search_numba` for k = 4: the candidates live in
+    local variables (registers) and are kept sorted by insertion.
+
+    Parameters:
+    ----------
+    query_points: np.ndarray
+        (M, 3+) array of query points
+    reference_points: np.ndarray
+        (N, 3+) array of reference points, N >= 4
+
+    Returns:
+    --------
+    indices: np.ndarray
+        (M, 4) matrix of integral indices, nearest first
+    """
+    n_query = query_points.shape[0]
+    indices = np.empty((n_query, 4), dtype=np.int64)
+    for q in numba.prange(n_query):
+        i0, i1, i2, i3 = _nearest_k4(query_points, q, reference_points)
+        indices[q, 0] = i0
+        indices[q, 1] = i1
+        indices[q, 2] = i2
+        indices[q, 3] = i3
+    return indices
+
+
+@numba.njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def knn_mean_price_k4(
+    query_points: np.ndarray, reference_points: np.ndarray, reference_prices: np.ndarray
+) -> np.ndarray:
+    """
+    Mean price of the 4 nearest reference points for each query point.
+
+    Fuses `knn_search_k4` with the price lookup, so neither the index matrix
+    nor the gathered (M, 4) prices are materialized.
+
+    Parameters:
+    ----------
+    query_points: np.ndarray
+        (M, 3+) array of query points
+    reference_points: np.ndarray
+        (N, 3+) array of reference points, N >= 4
+    reference_prices: np.ndarray
+        (N,) array of prices of the reference points
+
+    Returns:
+    --------
+    prices: np.ndarray
+        (M,) array of prices
+    """
+    n_query = query_points.shape[0]
+    prices = np.empty(n_query, dtype=reference_prices.dtype)
+    for q in numba.prange(n_query):
+        i0, i1, i2, i3 = _nearest_k4(query_points, q, reference_points)
+        price_sum = reference_prices[i0] + reference_prices[i1] + reference_prices[i2] + reference_prices[i3]
+        prices[q] = price_sum / 4
+    return prices
 
 
 def knn_search(
@@ -52,8 +274,50 @@ def knn_search(
     indices: np.ndarray
         (N, k) matrix of integral indices
     """
-    distances = calculate_distances(query_points, reference_points).T
-    return np.argpartition(distances, k, axis=0)[:k].T
+    if k == 4 and reference_points.shape[0] >= 4:
+        return knn_search_k4(query_points, reference_points)
+    if k <= STREAMING_MAX_K and k <= reference_points.shape[0]:
+        return knn_search_numba(query_points, reference_points, k)
+
+    # Process the queries in blocks whose distance matrix fits in L2
+    batch_size = cache_batch_size(reference_points.shape[0])
+    return np.concatenate(
+        [
+            _knn_search_exhaustive(query_batch, reference_points, k)
+            for query_batch in split_into_batches(query_points, batch_size)
+        ]
+    )
+
+
+def _is_float32(*arrays: np.ndarray) -> bool:
+    # The ahead-of-time compiled kernels only accept float32 arrays
+    return all(array.dtype == np.float32 for array in arrays)
+
+
+def _knn_search_exhaustive(query_points: np.ndarray, reference_points: np.ndarray, k: int) -> np.ndarray:
+    # sqrt is monotonic, so squared distances give the same neighbours;
+    # partitioning the contiguous (M, N) rows avoids transposed copies
+    distances = calculate_squared_distances(query_points, reference_points)
+    return np.argpartition(distances, k, axis=1)[:, :k]
+
+
+def cache_batch_size(n_reference: int, itemsize: int = np.dtype(np.float32).itemsize) -> int:
+    """
+    Number of query points whose distances to all reference points fit in L2 cache.
+
+    Parameters:
+    ----------
+    n_reference: int
+        Number of reference points
+    itemsize: int
+        Size of a single distance value in bytes
+
+    Returns:
+    --------
+    batch_size: int
+        Query block size, at least MIN_BATCH_SIZE
+    """
+    return max(MIN_BATCH_SIZE, L2_CACHE_BYTES // (n_reference * itemsize))
 
 
 def create_grid(n_points: int = N_POINTS) -> tuple[np.ndarray, ...]:
@@ -69,8 +333,8 @@ def create_grid(n_points: int = N_POINTS) -> tuple[np.ndarray, ...]:
     """
     # Note: Tested indirectly via `create_query_points`
     # TODO: Add floor
-    x = np.linspace(-LIMIT, LIMIT, n_points)
-    y = np.linspace(-LIMIT, LIMIT, n_points)
+    x = np.linspace(-LIMIT, LIMIT, n_points, dtype=np.float32)
+    y = np.linspace(-LIMIT, LIMIT, n_points, dtype=np.float32)
     return tuple(arr.flatten() for arr in np.meshgrid(x, y))
 
 
@@ -83,11 +347,47 @@ def create_query_points(n_points: int = N_POINTS, floor: int = 1) -> np.ndarray:
     query_points: np.ndarray
         (n_points x n_points, 3) array of query points
     """
-    x, y = create_grid(n_points=n_points)
-    return np.vstack([x, y, np.ones(x.shape[0]) * floor]).T
+    # Same point order as `create_grid`, written straight into one (n², 3) buffer
+    query_points = np.empty((n_points * n_points, 3), dtype=np.float32)
+    grid = query_points.reshape(n_points, n_points, 3)  # view, not a copy
+    axis = np.linspace(-LIMIT, LIMIT, n_points, dtype=np.float32)
+    grid[:, :, 0] = axis[np.newaxis, :]
+    grid[:, :, 1] = axis[:, np.newaxis]
+    grid[:, :, 2] = floor
+    return query_points
+
+
+def build_kdtree(reference_points: np.ndarray, leafsize: int = KDTREE_LEAFSIZE) -> cKDTree:
+    """
+    Build a k-d tree over the (x, y, floor) coordinates of the reference points.
 
+    The tree is built once and can then be shared (e.g. via `ray.put`) by all tasks.
+
+    Parameters:
+    ----------
+    reference_points: np.ndarray
+        (M, 3+) array of reference points
+    leafsize: int
+        Number of points at which the tree switches to brute force
 
-def compute_prices(query_points, reference_points, k: int = DEFAULT_K):
+    Returns:
+    --------
+    tree: cKDTree
+        k-d tree indexed consistently with `reference_points`
+    """
+    return cKDTree(reference_points[:, :3], leafsize=leafsize)
+
+
+def compute_prices(
+    query_points,
+    reference_points,
+    reference_prices,
+    k: int = DEFAULT_K,
+    *,
+    tree: cKDTree | None = None,
+    workers: int = -1,
+    native: bool = False,
+):
     """
     Find prices for N data_points.
 
@@ -96,32 +396,64 @@ def compute_prices(query_points, reference_points, k: int = DEFAULT_K):
     query_points: np.ndarray
         (N, 3) array of query points
     reference_points: np.ndarray
-        (M, 4) array of data points with x, y, floor, and price
+        (M, 3) array of data points with x, y, and floor
+    reference_prices: np.ndarray
+        (M,) array of prices of the data points
     k: int
         Number of nearest neighbors to consider
+    tree: cKDTree, optional
+        Prebuilt k-d tree over `reference_points` (see `build_kdtree`).
+        If None, an exhaustive search is used.
+    workers: int
+        Number of threads for the k-d tree query (-1 uses all cores)
+    native: bool
+        For the exhaustive k=4 search, use the ahead-of-time compiled kernel
+        (see `build_knn_kernel.py`) if it is built. It is single-threaded and
+        slower than the JIT kernel, but has no compilation cost, which suits
+        short-lived single-CPU Ray workers.
 
     Returns:
     --------
     prices: np.ndarray
         (N,) array of prices
     """
-    indices = knn_search(query_points, reference_points, k)
-    prices: np.ndarray = reference_points[indices, 3]
+    if k > reference_points.shape[0]:
+        raise ValueError(f"k={k} exceeds the number of reference points ({reference_points.shape[0]})")
+
+    if tree is None:
+        # The fused kernel returns prices in their own (floating) dtype
+        if k == 4 and reference_points.shape[0] >= 4 and np.issubdtype(reference_prices.dtype, np.floating):
+            if native and HAS_NATIVE_KNN and _is_float32(query_points, reference_points, reference_prices):
+                from this_tutorial.knn_native import knn_mean_price_k4_f32
+
+                return knn_mean_price_k4_f32(query_points, reference_points, reference_prices)
+            return knn_mean_price_k4(query_points, reference_points, reference_prices)
+        indices = knn_search(query_points, reference_points, k)
+    else:
+        _, indices = tree.query(query_points[:, :3], k=k, workers=workers)
+        indices = indices.reshape(query_points.shape[0], k)
+    prices: np.ndarray = reference_prices[indices]
     return prices.mean(axis=1)
 
 
-def load_reference_points(path: Path = Path("data.parquet")) -> np.ndarray:
+def load_reference_points(path: Path = Path("data.parquet")) -> tuple[np.ndarray, np.ndarray]:
     """
     Load reference data points from a Parquet file.
 
     Returns:
     --------
     data_points: np.ndarray
-        (N, 4) array of data points with x, y, floor, and price columns
+        (N, 3) C-contiguous float32 array of data points with x, y, and floor columns
+    prices: np.ndarray
+        (N,) float32 array of prices
     """
 
-    df = pd.read_parquet(path)
-    return df[["x", "y", "floor", "price"]].to_numpy().astype(float)
+    df = pl.read_parquet(path, columns=["x", "y", "floor", "price"])
+    # One allocation straight into the row-major layout; no per-column copies
+    data_points = df.select(pl.col("x", "y", "floor").cast(pl.Float32)).to_numpy(order="c")
+    # A single Float32 column converts without a copy
+    prices = df.get_column("price").cast(pl.Float32).to_numpy()
+    return data_points, prices
 
 
 def combine_points_and_prices(
@@ -171,34 +503,166 @@ def split_into_batches(array: np.ndarray, max_size: int) -> list[np.ndarray]:
     return [array[i:i + max_size] for i in range(0, len(array), max_size)]
 
 
-compute_prices_ray = ray.remote(compute_prices)
+def gpu_available() -> bool:
+    """Check whether CuPy is installed and can see at least one CUDA device."""
+    try:
+        import cupy
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except Exception:  # ImportError, or CUDA runtime / driver errors
+        return False
 
 
-if __name__ == "__main__":
+def compute_prices_gpu(query_points, reference_points, reference_prices, k: int = DEFAULT_K):
+    """
+    Find prices for N data_points on a GPU using CuPy.
+
+    Distances use the same |q - r|² = |q|² + |r|² - 2 q·r identity as
+    `calculate_squared_distances`, so the bulk of the work is one cuBLAS GEMM.
+
+    Parameters:
+    ----------
+    query_points: np.ndarray
+        (N, 3) array of query points
+    reference_points: np.ndarray
+        (M, 3) array of data points with x, y, and floor
+    reference_prices: np.ndarray
+        (M,) array of prices of the data points
+    k: int
+        Number of nearest neighbors to consider
+
+    Returns:
+    --------
+    prices: np.ndarray
+        (N,) array of prices (copied back to the host)
+    """
+    import cupy as cp
+
+    query = cp.asarray(query_points[:, :3], dtype=cp.float32)
+    reference = cp.asarray(reference_points[:, :3], dtype=cp.float32)
+    squared_distances = (
+        cp.einsum("ij,ij->i", query, query)[:, cp.newaxis]
+        + cp.einsum("ij,ij->i", reference, reference)[cp.newaxis, :]
+        - 2.0 * cp.matmul(query, reference.T)
+    )
+    indices = cp.argpartition(squared_distances, k, axis=1)[:, :k]
+    prices = cp.asarray(reference_prices)[indices]
+    return cp.asnumpy(prices.mean(axis=1))
+
+
+# One CPU per task; SPREAD places batches across nodes rather than packing one
+compute_prices_ray = ray.remote(num_cpus=1, scheduling_strategy="SPREAD")(compute_prices)
+compute_prices_gpu_ray = ray.remote(num_gpus=1)(compute_prices_gpu)
+
+
+def submit_batch(function, remote_function, query_points: np.ndarray, *args, **kwargs) -> ray.ObjectRef:
+    """
+    Run `remote_function` on Ray, or `function` in-process for small batches.
+
+    Small batches would spend most of their time in Ray's task scheduling, so
+    they are computed directly (with any `ObjectRef` arguments resolved) and
+    only their result is put into the object store.
+
+    Parameters:
+    ----------
+    function: Callable
+        Plain function to call for small batches
+    remote_function: ray.remote_function.RemoteFunction
+        Ray remote version of `function`
+    query_points: np.ndarray
+        (N, 3) array of query points, passed as the first argument
+    *args, **kwargs:
+        Remaining arguments; `ObjectRef`s are dereferenced for local calls
+
+    Returns:
+    --------
+    ray.ObjectRef
+        Reference to the result, in both cases
+    """
+    if query_points.shape[0] >= MIN_REMOTE_BATCH_SIZE:
+        return remote_function.remote(query_points, *args, **kwargs)
+
+    args = [ray.get(arg) if isinstance(arg, ray.ObjectRef) else arg for arg in args]
+    kwargs = {key: ray.get(arg) if isinstance(arg, ray.ObjectRef) else arg for key, arg in kwargs.items()}
+    return ray.put(function(query_points, *args, **kwargs))
+
+
+@click.command()
+@click.option("--gpu", is_flag=True, help="Compute prices on a GPU with CuPy (falls back to CPU).")
+@click.option(
+    "--exhaustive",
+    is_flag=True,
+    help="Use an exhaustive search (ahead-of-time compiled if built) instead of a k-d tree on CPU.",
+)
+def run(*, gpu: bool, exhaustive: bool):
+    """
+    Compute prices on a grid of query points using Ray.
+    """
+    # With the TBB threading layer, a process that ran parallel Numba kernels and
+    # Ray hangs on exit, so only fall back to TBB when nothing else is available.
+    # Small batches run in this process (see `submit_batch`), so set it up front.
+    numba.config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
     ray.init()
 
-    data_points = load_reference_points()
-    data_points_ref = ray.put(data_points)  # Store this
+    if gpu and not gpu_available():
+        logger.warning("CuPy or a CUDA device is not available, falling back to CPU")
+        gpu = False
+
+    data_points, data_prices = load_reference_points()
+    # Put the reference data into the shared object store once; every task
+    # receives the same references instead of its own serialised copy
+    data_points_ref = ray.put(data_points)
+    data_prices_ref = ray.put(data_prices)
 
     query_points = create_query_points(1000)
-    batch_size = 1000
+    batch_size = RAY_BATCH_SIZE
 
-    query_point_batches = [
-        query_points[i : i + batch_size, :]
-        for i in range(0, query_points.shape[0] // batch_size * batch_size, batch_size)
-    ]
+    query_point_batches = split_into_batches(query_points, batch_size)
     logger.info(f"Submitting {len(query_point_batches)} batches of query points")
 
     # Compute prices for the query points
-    prices = ray.get(
-        [
-            compute_prices_ray.remote(query_point_batch, data_points_ref)
+    if gpu:
+        futures = [
+            submit_batch(
+                compute_prices_gpu, compute_prices_gpu_ray, query_point_batch, data_points_ref, data_prices_ref
+            )
             for query_point_batch in query_point_batches
         ]
-    )
-    prices = np.concatenate(prices)
+    elif exhaustive:
+        if not HAS_NATIVE_KNN:
+            logger.warning("knn_native is not built (see build_knn_kernel.py), workers will JIT compile")
+        futures = [
+            submit_batch(
+                compute_prices,
+                compute_prices_ray,
+                query_point_batch,
+                data_points_ref,
+                data_prices_ref,
+                native=True,
+            )
+            for query_point_batch in query_point_batches
+        ]
+    else:
+        tree_ref = ray.put(build_kdtree(data_points))  # Build once, share with all tasks
+        futures = [
+            # Ray already runs one task per CPU, so each tree query is single-threaded
+            submit_batch(
+                compute_prices,
+                compute_prices_ray,
+                query_point_batch,
+                data_points_ref,
+                data_prices_ref,
+                tree=tree_ref,
+                workers=1,
+            )
+            for query_point_batch in query_point_batches
+        ]
+    prices = np.concatenate(ray.get(futures))
     output_df = combine_points_and_prices(
         query_points=query_points,
         prices=prices,
     )
     print(output_df)
+
+
+if __name__ == "__main__":
+    run()
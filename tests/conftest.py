@@ -1,6 +1,11 @@
+import numba
 import numpy as np
 import pytest
 
+# Parallel Numba kernels (TBB threading layer) and Ray in one process hang on
+# exit; test_knn_ray starts Ray after running such kernels, as `knn_ray.run` does
+numba.config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+
 
 @pytest.fixture
 def dataset(n_dataset, dims):
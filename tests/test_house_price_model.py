@@ -0,0 +1,137 @@
+from pathlib import Path
+
+import numpy as np
+from numpy.testing import assert_allclose
+import pytest
+
+from this_tutorial.house_price_model import FAST_EXP_NEG_CUTOFF, fast_exp_neg, house_price_model, load_city_params
+
+CITY_DEFINITION_PATH = Path(__file__).parents[1] / "city_definition.json"
+
+
+@pytest.fixture
+def city_params():
+    return {
+        "high_end_centers": [
+            {"x": 0, "y": 0, "peak_price": 2000, "influence_radius": 2},
+            {"x": 2, "y": 1, "peak_price": 1500, "influence_radius": 2.5},
+            {"x": -1, "y": 3, "peak_price": 1200, "influence_radius": 1.5},
+        ],
+        "base_price": 500,
+        "floor_premium": 0.02,
+        "distance_decay": 0.3,
+        "noise_factor": 0,
+    }
+
+
+def reference_house_price_model(x, y, floor, city_params):
+    """Straightforward per-center loop the vectorised model must agree with."""
+    x, y, floor = np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in (x, y, floor)))
+    price = np.full(x.shape, city_params["base_price"], dtype=float)
+    for center in city_params["high_end_centers"]:
+        distance = np.sqrt((x - center["x"]) ** 2 + (y - center["y"]) ** 2)
+        influence = center["peak_price"] * np.exp(
+            -city_params["distance_decay"] * (distance / center["influence_radius"]) ** 2
+        )
+        price = np.maximum(price, influence)
+    return price * (1 + city_params["floor_premium"]) ** (floor - 1)
+
+
+def test_house_price_model_matches_reference(city_params):
+    x = np.random.rand(200) * 20 - 10
+    y = np.random.rand(200) * 20 - 10
+    floor = np.random.randint(1, 20, 200)
+
+    prices = house_price_model(x, y, floor, city_params)
+
+    assert prices.shape == (200,)
+    assert_allclose(prices, reference_house_price_model(x, y, floor, city_params), rtol=1e-6)
+
+
+def test_house_price_model_broadcasts_grid(city_params):
+    X, Y = np.meshgrid(np.linspace(-8, 8, 7), np.linspace(-8, 8, 5))
+
+    prices = house_price_model(X, Y, 3, city_params)
+
+    assert prices.shape == (5, 7)
+    assert_allclose(prices, reference_house_price_model(X, Y, 3, city_params), rtol=1e-6)
+
+
+def test_house_price_model_scalar(city_params):
+    price = house_price_model(0, 0, 1, city_params)
+
+    assert np.ndim(price) == 0
+    assert_allclose(price, 2000)
+
+
+def test_house_price_model_without_centers(city_params):
+    city_params["high_end_centers"] = []
+
+    prices = house_price_model(np.zeros(3), np.zeros(3), 1, city_params)
+
+    assert_allclose(prices, city_params["base_price"])
+
+
+def test_house_price_model_noise_is_deterministic(city_params):
+    city_params["noise_factor"] = 0.1
+    x = np.random.rand(50) * 20 - 10
+    y = np.random.rand(50) * 20 - 10
+    global_state = np.random.get_state()[1].copy()
+
+    prices = house_price_model(x, y, 1, city_params)
+
+    assert_allclose(prices, house_price_model(x, y, 1, city_params))
+    assert np.array_equal(np.random.get_state()[1], global_state)
+    noiseless = reference_house_price_model(x, y, 1, city_params)
+    assert np.all(np.abs(prices / noiseless - 1) <= 0.05)
+
+
+def test_house_price_model_noise_ignores_dtype(city_params):
+    city_params["noise_factor"] = 0.1
+    x = np.array([1, 2, 3])
+
+    prices = house_price_model(x, 0, 1, city_params)
+
+    assert_allclose(prices, house_price_model(x.astype(float), 0.0, 1, city_params))
+    assert_allclose(prices, house_price_model(x.astype(np.float32), np.int32(0), 1, city_params))
+
+
+def test_house_price_model_noise_from_rng(city_params):
+    city_params["noise_factor"] = 0.1
+    x = np.linspace(-5, 5, 20)
+
+    prices = house_price_model(x, 0, 1, city_params, rng=np.random.default_rng(1))
+
+    assert_allclose(prices, house_price_model(x, 0, 1, city_params, rng=np.random.default_rng(1)))
+    assert not np.allclose(prices, house_price_model(x, 0, 1, city_params, rng=np.random.default_rng(2)))
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_fast_exp_neg(dtype):
+    x = np.linspace(0, FAST_EXP_NEG_CUTOFF, 10_001).astype(dtype)
+
+    result = fast_exp_neg(x)
+
+    assert result.dtype == dtype
+    assert_allclose(result, np.exp(-x.astype(float)), rtol=1e-6)
+    assert_allclose(fast_exp_neg(np.array([FAST_EXP_NEG_CUTOFF + 1, 1e6], dtype=dtype)), 0)
+    with np.errstate(invalid="ignore"):
+        assert np.isnan(fast_exp_neg(np.array([np.nan], dtype=dtype))).all()
+
+
+def test_house_price_model_propagates_nan(city_params):
+    with np.errstate(invalid="ignore"):
+        prices = house_price_model(np.array([np.nan, 0.0]), 0, 1, city_params)
+
+    assert np.isnan(prices[0])
+    assert_allclose(prices[1], 2000)
+
+
+def test_load_city_params_is_cached():
+    load_city_params.cache_clear()
+
+    params = load_city_params(CITY_DEFINITION_PATH)
+
+    assert load_city_params(CITY_DEFINITION_PATH) is params
+    assert load_city_params.cache_info().misses == 1
+    assert len(params["high_end_centers"]) == 4
@@ -1,8 +1,11 @@
 import numpy as np
 from numpy.testing import assert_allclose
+import polars as pl
 import pytest
+import ray
 
-from this_tutorial.knn_ray import create_grid, create_query_points, calculate_distances, knn_search, compute_prices, split_into_batches
+from this_tutorial import knn_ray
+from this_tutorial.knn_ray import create_grid, create_query_points, calculate_distances, calculate_squared_distances, knn_search, knn_search_numba, knn_search_k4, knn_mean_price_k4, compute_prices, build_kdtree, cache_batch_size, load_reference_points, compute_prices_gpu, gpu_available, split_into_batches, submit_batch
 
 
 def test_create_grid():
@@ -22,6 +25,11 @@ def test_create_query_points():
     assert np.all(query_points[:,0] >= -10) and np.all(query_points[:,0] <= 10)
     assert np.all(query_points[:,1] >= -10) and np.all(query_points[:,1] <= 10)
     assert_allclose(query_points[17], np.asarray([0., 5., 2.]))
+    assert query_points.dtype == np.float32
+    assert query_points.flags.c_contiguous
+    x, y = create_grid(n_points=5)
+    assert_allclose(query_points[:,0], x)
+    assert_allclose(query_points[:,1], y)
 
 
 def test_calculate_distances():
@@ -37,12 +45,28 @@ def test_calculate_distances():
         [np.sqrt(3), 1.0, np.sqrt(3), 0.0]
     ])
     
-    assert_allclose(distances, expected_distances)
+    assert_allclose(distances, expected_distances, rtol=1e-6)
+
+
+@pytest.mark.parametrize("use_simsimd", [True, False])
+def test_calculate_squared_distances_matches_broadcasting(use_simsimd):
+    if use_simsimd and not knn_ray.HAS_SIMSIMD:
+        pytest.skip("simsimd is not installed")
+    query_points = np.random.rand(7, 3) * 20 - 10
+    reference_points = np.random.rand(11, 3) * 20 - 10
+
+    squared_distances = calculate_squared_distances(query_points, reference_points, use_simsimd=use_simsimd)
+    expected = np.sum((query_points[:, np.newaxis, :] - reference_points[np.newaxis, :, :]) ** 2, axis=-1)
+
+    assert squared_distances.shape == (7, 11)
+    assert squared_distances.dtype == np.float32
+    assert np.all(squared_distances >= 0)
+    assert_allclose(squared_distances, expected, rtol=1e-5, atol=1e-4)
 
 
 def test_knn_search():
     query_points = np.array([[0, 0, 1], [3, 3, 3]])
-    reference_points = np.array([[0, 0, 0, 7], [1, 1, 0, 2], [2, 2, 0, 5], [1, 1, 1, 6]])
+    reference_points = np.array([[0, 0, 0], [1, 1, 0], [2, 2, 0], [1, 1, 1]])
     
     k = 2
     indices = knn_search(query_points, reference_points, k)
@@ -53,11 +77,71 @@ def test_knn_search():
     assert np.array_equal(indices, expected_indices) 
 
 
+@pytest.mark.parametrize("k", [1, 4, 10])
+def test_knn_search_numba_matches_argpartition(k):
+    query_points = np.random.rand(20, 3) * 20 - 10
+    reference_points = np.random.rand(200, 3) * 20 - 10
+
+    indices = knn_search_numba(query_points, reference_points, k)
+
+    squared_distances = calculate_squared_distances(query_points, reference_points)
+    expected = np.argpartition(squared_distances, k, axis=1)[:, :k]
+    assert indices.shape == (20, k)
+    assert np.array_equal(np.sort(indices, axis=1), np.sort(expected, axis=1))
+
+
+def test_knn_search_k4_matches_argpartition():
+    query_points = np.random.rand(20, 3) * 20 - 10
+    reference_points = np.random.rand(200, 3) * 20 - 10
+
+    indices = knn_search_k4(query_points, reference_points)
+
+    squared_distances = np.sum((query_points[:, np.newaxis, :] - reference_points[np.newaxis, :, :]) ** 2, axis=-1)
+    expected = np.argsort(squared_distances, axis=1)[:, :4]
+    assert indices.shape == (20, 4)
+    assert np.array_equal(indices, expected)
+
+
+def test_knn_mean_price_k4():
+    query_points = np.random.rand(20, 3).astype(np.float32) * 20 - 10
+    reference_points = np.random.rand(200, 3).astype(np.float32) * 20 - 10
+    reference_prices = np.random.rand(200).astype(np.float32) * 1000
+
+    prices = knn_mean_price_k4(query_points, reference_points, reference_prices)
+
+    expected = reference_prices[knn_search_k4(query_points, reference_points)].mean(axis=1)
+    assert prices.shape == (20,)
+    assert prices.dtype == np.float32
+    assert_allclose(prices, expected, rtol=1e-6)
+
+
+@pytest.mark.skipif(not knn_ray.HAS_NATIVE_KNN, reason="knn_native is not built (see build_knn_kernel.py)")
+def test_native_knn_matches_jit():
+    from this_tutorial.knn_native import knn_k4_f32, knn_mean_price_k4_f32
+
+    query_points = np.random.rand(20, 3).astype(np.float32) * 20 - 10
+    reference_points = np.random.rand(200, 3).astype(np.float32) * 20 - 10
+    reference_prices = np.random.rand(200).astype(np.float32) * 1000
+
+    assert np.array_equal(knn_k4_f32(query_points, reference_points), knn_search_k4(query_points, reference_points))
+    assert_allclose(
+        knn_mean_price_k4_f32(query_points, reference_points, reference_prices),
+        knn_mean_price_k4(query_points, reference_points, reference_prices),
+        rtol=1e-6,
+    )
+    assert_allclose(
+        compute_prices(query_points, reference_points, reference_prices, native=True),
+        knn_mean_price_k4(query_points, reference_points, reference_prices),
+        rtol=1e-6,
+    )
+
+
 def test_compute_prices():
     query_points = np.array([[0, 0, 1], [3, 3, 3]])
-    reference_points = np.array([[0, 0, 0, 7], [1, 1, 0, 2], [2, 2, 0, 5], [1, 1, 1, 6]])
+    reference_points = np.array([[0, 0, 0], [1, 1, 0], [2, 2, 0], [1, 1, 1]])
+    reference_prices = np.array([7, 2, 5, 6])
     
-    prices = compute_prices(query_points, reference_points, k=2)
+    prices = compute_prices(query_points, reference_points, reference_prices, k=2)
     
     assert prices.shape == (2,)
     expected_prices = np.array([6.5, 5.5])
@@ -65,6 +149,91 @@ def test_compute_prices():
     assert_allclose(prices, expected_prices)
 
 
+@pytest.mark.parametrize("use_tree", [True, False])
+def test_compute_prices_k_exceeds_reference_points(use_tree):
+    query_points = np.array([[0, 0, 1]])
+    reference_points = np.array([[0, 0, 0], [1, 1, 0], [2, 2, 0]])
+    reference_prices = np.array([10.0, 20.0, 300.0])
+    tree = build_kdtree(reference_points) if use_tree else None
+
+    with pytest.raises(ValueError):
+        compute_prices(query_points, reference_points, reference_prices, k=4, tree=tree)
+
+
+def test_compute_prices_k4_integral_prices():
+    query_points = np.array([[0, 0, 1]])
+    reference_points = np.array([[0, 0, 0], [1, 1, 0], [2, 2, 0], [1, 1, 1], [9, 9, 9]])
+    reference_prices = np.array([7, 2, 5, 6, 100])
+
+    prices = compute_prices(query_points, reference_points, reference_prices, k=4)
+
+    assert_allclose(prices, [5.0])
+
+
+@pytest.mark.parametrize("k", [1, 4])
+def test_compute_prices_kdtree_matches_exhaustive(k):
+    query_points = np.random.rand(30, 3) * 20 - 10
+    reference_points = np.random.rand(500, 3) * 20 - 10
+    reference_prices = np.random.rand(500) * 1000
+
+    tree = build_kdtree(reference_points)
+    prices = compute_prices(query_points, reference_points, reference_prices, k=k, tree=tree)
+
+    assert prices.shape == (30,)
+    assert_allclose(prices, compute_prices(query_points, reference_points, reference_prices, k=k))
+
+
+@pytest.mark.skipif(not gpu_available(), reason="CuPy with a CUDA device is not available")
+def test_compute_prices_gpu_matches_cpu():
+    query_points = np.random.rand(30, 3).astype(np.float32) * 20 - 10
+    reference_points = np.random.rand(500, 3).astype(np.float32) * 20 - 10
+    reference_prices = np.random.rand(500).astype(np.float32) * 1000
+
+    prices = compute_prices_gpu(query_points, reference_points, reference_prices, k=4)
+
+    assert prices.shape == (30,)
+    assert_allclose(prices, compute_prices(query_points, reference_points, reference_prices, k=4), rtol=1e-5)
+
+
+def test_load_reference_points(tmp_path):
+    path = tmp_path / "data.parquet"
+    pl.DataFrame(
+        {"x": [0.5, -1.0], "y": [2.0, 3.5], "floor": [1, 7], "price": [100.0, 250.5], "extra": [0, 0]}
+    ).write_parquet(path)
+
+    data_points, prices = load_reference_points(path)
+
+    assert data_points.dtype == np.float32 and prices.dtype == np.float32
+    assert data_points.flags.c_contiguous
+    assert_allclose(data_points, [[0.5, 2.0, 1.0], [-1.0, 3.5, 7.0]])
+    assert_allclose(prices, [100.0, 250.5])
+
+
+@pytest.mark.parametrize(
+    ("n_reference", "expected"),
+    [
+        (10, 13107),
+        (2048, 64),
+        (10_000, 64),
+    ]
+)
+def test_cache_batch_size(n_reference, expected):
+    assert cache_batch_size(n_reference) == expected
+
+
+def test_knn_search_exhaustive_in_blocks():
+    k = knn_ray.STREAMING_MAX_K + 1
+    query_points = np.random.rand(150, 3) * 20 - 10
+    reference_points = np.random.rand(3000, 3) * 20 - 10
+
+    indices = knn_search(query_points, reference_points, k)
+
+    squared_distances = calculate_squared_distances(query_points, reference_points)
+    expected = np.argpartition(squared_distances, k, axis=1)[:, :k]
+    assert indices.shape == (150, k)
+    assert np.array_equal(np.sort(indices, axis=1), np.sort(expected, axis=1))
+
+
 @pytest.mark.parametrize(
     ("points", "batch_size", "n_batches", "last_batch_size"),
     [
@@ -83,4 +252,37 @@ def test_split_into_batches(points, batch_size, n_batches, last_batch_size):
         assert batch.shape[0] <= batch_size
         assert batch.shape[1] == 3
 
-    batches[-1].shape[0] == last_batch_size
\ No newline at end of file
+    batches[-1].shape[0] == last_batch_size
+
+
+@pytest.fixture(scope="module")
+def ray_local():
+    ray.init(num_cpus=1, include_dashboard=False)
+    yield
+    ray.shutdown()
+
+
+class _CountingRemote:
+    def __init__(self, function):
+        self.remote_function = ray.remote(function)
+        self.calls = 0
+
+    def remote(self, *args, **kwargs):
+        self.calls += 1
+        return self.remote_function.remote(*args, **kwargs)
+
+
+@pytest.mark.parametrize(("n_query", "remote_calls"), [(10, 0), (knn_ray.MIN_REMOTE_BATCH_SIZE, 1)])
+def test_submit_batch(ray_local, n_query, remote_calls):
+    query_points = np.random.rand(n_query, 3) * 20 - 10
+    reference_points = np.random.rand(100, 3) * 20 - 10
+    reference_prices = np.random.rand(100) * 1000
+    remote_function = _CountingRemote(compute_prices)
+
+    result_ref = submit_batch(
+        compute_prices, remote_function, query_points, ray.put(reference_points), reference_prices, k=2
+    )
+
+    assert isinstance(result_ref, ray.ObjectRef)
+    assert remote_function.calls == remote_calls
+    assert_allclose(ray.get(result_ref), compute_prices(query_points, reference_points, reference_prices, k=2))